@@ -18,31 +18,142 @@
 # Simple version of xiangshan python wrapper
 
 import argparse
+import copy
+import functools
+import glob
+import io
 import json
 import os
+import pickle
 import random
 import signal
 import subprocess
 import sys
+import threading
 import time
 import shlex
-import psutil
+import shutil
 import re
 
+NUMA_RE = re.compile(r'numactl +.*-C +([0-9]+)-([0-9]+)')
+
 def find_files_with_suffix(root_dir, suffixes):
+    # scandir instead of os.walk: d_type from readdir avoids a stat() per entry
+    suffixes = tuple(suffixes)
     matching_files = []
-    for dirpath, _, filenames in os.walk(root_dir):
-        for filename in filenames:
-            if any(filename.endswith(suffix) for suffix in suffixes):
-                absolute_path = os.path.join(dirpath, filename)
-                matching_files.append(absolute_path)
+    pending_dirs = [root_dir]
+    while pending_dirs:
+        try:
+            entries = os.scandir(pending_dirs.pop())
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        pending_dirs.append(entry.path)
+                    elif entry.name.endswith(suffixes):
+                        matching_files.append(entry.path)
+                except OSError:
+                    pass
     return matching_files
 
-def load_all_gcpt(gcpt_paths):
-    all_gcpt = []
+def find_missing_files(paths):
+    # one scandir per parent directory instead of one stat per file
+    present = {}
+    for dirname in set(map(os.path.dirname, paths)):
+        try:
+            with os.scandir(dirname) as entries:
+                present[dirname] = {entry.name for entry in entries}
+        except OSError:
+            present[dirname] = set()
+    return [path for path in paths if os.path.basename(path) not in present[os.path.dirname(path)]]
+
+def tee_output(pipe, log_file):
+    sys.stdout.flush()
+    with pipe, open(log_file, "wb") as log:
+        while True:
+            data = os.read(pipe.fileno(), 1 << 16)
+            if not data:
+                break
+            log.write(data)
+            sys.stdout.buffer.write(data)
+            sys.stdout.buffer.flush()
+
+def find_markers_in_file(path, markers, chunk_size=1 << 20):
+    # stream the file in binary chunks so that huge logs are never decoded or held in memory
+    found = set()
+    overlap = max(map(len, markers)) - 1
+    tail = b""
+    with open(path, "rb") as f:
+        while len(found) < len(markers):
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            window = tail + chunk
+            found.update(marker for marker in markers if marker in window)
+            tail = window[-overlap:] if overlap else b""
+    return found
+
+# listings are keyed by the mtime of each checkpoint root; checkpoints replaced
+# deeper in the tree do not change it, so sample_one_gcpt rescans a root on a miss
+GCPT_CACHE = os.path.expanduser("~/.cache/xiangshan_gcpt.pkl")
+
+def load_gcpt_cache():
+    try:
+        with open(GCPT_CACHE, "rb") as f:
+            return pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        return {}
+
+def save_gcpt_cache(cache):
+    try:
+        os.makedirs(os.path.dirname(GCPT_CACHE), exist_ok=True)
+        tmp_path = f"{GCPT_CACHE}.{os.getpid()}"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(cache, f)
+        os.replace(tmp_path, GCPT_CACHE)
+    except OSError:
+        pass
+
+def load_gcpt_lists(gcpt_paths, rescan=()):
+    cache = load_gcpt_cache()
+    roots = []
     for gcpt_path in gcpt_paths:
-        all_gcpt.extend(find_files_with_suffix(gcpt_path, ['.zstd', '.gz']))
-    return all_gcpt
+        try:
+            roots.append((gcpt_path, os.stat(gcpt_path).st_mtime_ns))
+        except OSError:
+            pass
+    stale = [(path, mtime) for path, mtime in roots
+             if path in rescan or cache.get(path, (None,))[0] != mtime]
+    if stale:
+        from concurrent.futures import ThreadPoolExecutor
+        # each readdir blocks on an NFS round trip, so walk stale roots concurrently
+        with ThreadPoolExecutor(max_workers=min(16, len(stale))) as executor:
+            results = executor.map(lambda root: find_files_with_suffix(root[0], ['.zstd', '.gz']), stale)
+            for (path, mtime), files in zip(stale, results):
+                cache[path] = (mtime, files)
+        save_gcpt_cache(cache)
+    return [(path, cache[path][1]) for path, _ in roots]
+
+def sample_one_gcpt(gcpt_paths):
+    rescanned = set()
+    rescan = ()
+    while True:
+        # index into the per-root lists instead of concatenating all of them
+        gcpt_lists = load_gcpt_lists(gcpt_paths, rescan)
+        index = random.SystemRandom().randrange(sum(len(files) for _, files in gcpt_lists))
+        for root, files in gcpt_lists:
+            if index < len(files):
+                break
+            index -= len(files)
+        chosen = files[index]
+        # a fresh listing of this root is trusted, a cached one is checked first
+        if root in rescanned or os.path.exists(chosen):
+            return chosen
+        print(f"{chosen} no longer exists, rescanning {root}")
+        rescanned.add(root)
+        rescan = (root,)
 
 class XSArgs(object):
     script_path = os.path.realpath(__file__)
@@ -87,8 +198,10 @@ class XSArgs(object):
         # emu arguments
         self.max_instr = args.max_instr
         self.ram_size = args.ram_size
-        self.seed = random.randint(0, 9999)
+        # 31 bits so that emu can still parse it as a signed int
+        self.seed = int.from_bytes(os.urandom(4), "little") & 0x7fffffff
         self.numa = args.numa
+        self.numa_policy = args.numa_policy
         self.diff = args.diff
         if args.spike and "nemu" in args.diff:
             self.diff = self.diff.replace("nemu-interpreter", "spike")
@@ -96,10 +209,14 @@ class XSArgs(object):
         self.disable_diff = args.no_diff
         self.disable_db = args.no_db
         self.gcpt_restore_bin = args.gcpt_restore_bin
-        self.pgo = args.pgo
+        self.pgo = self.__resolve_pgo(args.pgo)
         self.pgo_max_cycle = args.pgo_max_cycle
         self.pgo_emu_args = args.pgo_emu_args
         self.llvm_profdata = args.llvm_profdata
+        self.bolt = args.bolt
+        self.bolt_perf_args = args.bolt_perf_args
+        self.verbose = args.verbose
+        self.shown = False
         # wave dump path
         if args.wave_dump is not None:
             self.set_wave_home(args.wave_dump)
@@ -121,12 +238,10 @@ class XSArgs(object):
         chisel_args = [
             (self.enable_log, "enable-log")
         ]
-        args = map(lambda x: x[1], filter(lambda arg: arg[0], chisel_args))
-        if prefix is not None:
-            args = map(lambda x: prefix + x, args)
-        return args
+        prefix = prefix or ""
+        return [prefix + name for enable, name in chisel_args if enable]
 
-    def get_makefile_args(self):
+    def get_makefile_args(self, escape=True):
         makefile_args = [
             (self.threads,       "EMU_THREADS"),
             (self.with_dramsim3, "WITH_DRAMSIM3"),
@@ -146,8 +261,9 @@ class XSArgs(object):
             (self.llvm_profdata, "LLVM_PROFDATA"),
             (self.issue,         "ISSUE"),
         ]
-        args = filter(lambda arg: arg[0] is not None, makefile_args)
-        args = [(shlex.quote(str(arg[0])), arg[1]) for arg in args] # shell escape
+        args = [(str(val), name) for val, name in makefile_args if val is not None]
+        if escape:
+            args = [(shlex.quote(val), name) for val, name in args] # shell escape
         return args
 
     def get_emu_args(self):
@@ -157,33 +273,77 @@ class XSArgs(object):
             (self.seed,      "seed"),
             (self.ram_size,  "ram-size"),
         ]
-        args = filter(lambda arg: arg[0] is not None, emu_args)
-        return args
+        return [(val, name) for val, name in emu_args if val is not None]
+
+    # the arguments never change after construction, so format them only once
+    @functools.cached_property
+    def env_variables(self):
+        return self.get_env_variables()
+
+    @functools.cached_property
+    def chisel_args_str(self):
+        return " ".join(self.get_chisel_args(prefix="--"))
+
+    @functools.cached_property
+    def makefile_args_str(self):
+        return " ".join(f"{name}={val}" for val, name in self.get_makefile_args())
 
-    def show(self):
-        print("Extra environment variables:")
+    @functools.cached_property
+    def makefile_vars(self):
+        # unescaped NAME=value words for commands exec'ed without a shell
+        return [f"{name}={val}" for val, name in self.get_makefile_args(escape=False)]
+
+    @functools.cached_property
+    def emu_args_str(self):
+        return " ".join(f"--{name} {val}" for val, name in self.get_emu_args())
+
+    def show(self, title=None):
+        # the configuration is fixed, so only dump it again when asked to
+        if self.shown and not self.verbose:
+            if title is not None:
+                print(title)
+            return
+        self.shown = True
+        # collect everything and write it out at once instead of line by line
+        out = io.StringIO()
+        if title is not None:
+            print(f"{title} with the following configurations:", file=out)
+        print("Extra environment variables:", file=out)
         env = self.get_env_variables()
         for env_name in env:
-            print(f"{env_name}: {env[env_name]}")
-        print()
-        print("Chisel arguments:")
-        print(" ".join(self.get_chisel_args()))
-        print()
-        print("Makefile arguments:")
+            print(f"{env_name}: {env[env_name]}", file=out)
+        print(file=out)
+        print("Chisel arguments:", file=out)
+        print(" ".join(self.get_chisel_args()), file=out)
+        print(file=out)
+        print("Makefile arguments:", file=out)
         for val, name in self.get_makefile_args():
-            print(f"{name}={val}")
-        print()
-        print("emu arguments:")
+            print(f"{name}={val}", file=out)
+        print(file=out)
+        print("emu arguments:", file=out)
         for val, name in self.get_emu_args():
-            print(f"--{name} {val}")
-        print()
+            print(f"--{name} {val}", file=out)
+        print(file=out)
+        sys.stdout.write(out.getvalue())
+
+    def __resolve_pgo(self, pgo):
+        if pgo == "off":
+            return None
+        if pgo == "auto":
+            # the same training workload the CI builds use
+            pgo = os.path.join(self.noop_home, "ready-to-run", "coremark-2-iteration.bin")
+            if not os.path.isfile(pgo):
+                print(f"pgo: {pgo} not found, building without pgo")
+                return None
+        return pgo
 
     def __extract_path(self, path, env=None, default=None):
         if path is None and env is not None:
             path = os.getenv(env)
         if path is None and default is not None:
             path = default
-        path = os.path.realpath(path)
+        # abspath is pure string handling, realpath would lstat every component
+        path = os.path.abspath(path)
         return path
 
     def set_noop_home(self, path):
@@ -210,45 +370,81 @@ class XiangShan(object):
     def __init__(self, args):
         self.args = XSArgs(args)
         self.timeout = args.timeout
+        self.ci_jobs = args.ci_jobs
+        # cores handed out to emu processes of this driver that may not have started yet
+        self.claimed_cores = set()
+        self.claimed_cores_lock = threading.Lock()
+        # process groups started by __exec_cmd, so that an interrupted parallel run can kill them
+        self.running_procs = set()
+        self.running_procs_lock = threading.Lock()
+        self.stop_event = threading.Event()
 
-    def show(self):
-        self.args.show()
+    def show(self, title=None):
+        self.args.show(title)
 
     def make_clean(self):
         print("Clean up CI workspace")
         self.show()
-        return_code = self.__exec_cmd(f'make -C $NOOP_HOME clean')
+        return_code = self.__exec_cmd(["make", "-C", self.args.noop_home, "clean"])
         return return_code
 
     def generate_verilog(self):
-        print("Generating XiangShan verilog with the following configurations:")
-        self.show()
-        sim_args = " ".join(self.args.get_chisel_args(prefix="--"))
-        make_args = " ".join(map(lambda arg: f"{arg[1]}={arg[0]}", self.args.get_makefile_args()))
-        return_code = self.__exec_cmd(f'make -C $NOOP_HOME verilog SIM_ARGS="{sim_args}" {make_args}')
+        self.show("Generating XiangShan verilog")
+        return_code = self.__exec_make("verilog")
         return return_code
 
     def generate_sim_verilog(self):
-        print("Generating XiangShan sim-verilog with the following configurations:")
-        self.show()
-        sim_args = " ".join(self.args.get_chisel_args(prefix="--"))
-        make_args = " ".join(map(lambda arg: f"{arg[1]}={arg[0]}", self.args.get_makefile_args()))
-        return_code = self.__exec_cmd(f'make -C $NOOP_HOME sim-verilog SIM_ARGS="{sim_args}" {make_args}')
+        self.show("Generating XiangShan sim-verilog")
+        return_code = self.__exec_make("sim-verilog")
         return return_code
 
     def build_emu(self):
-        print("Building XiangShan emu with the following configurations:")
-        self.show()
-        sim_args = " ".join(self.args.get_chisel_args(prefix="--"))
-        make_args = " ".join(map(lambda arg: f"{arg[1]}={arg[0]}", self.args.get_makefile_args()))
-        threads = self.args.make_threads
-        return_code = self.__exec_cmd(f'make -C $NOOP_HOME emu -j{threads} SIM_ARGS="{sim_args}" {make_args}')
+        self.show("Building XiangShan emu")
+        return_code = self.__exec_make("emu", f"-j{self.args.make_threads}")
+        if return_code == 0 and self.args.bolt:
+            return_code = self.bolt_emu()
         return return_code
 
+    def bolt_emu(self):
+        # post-link layout optimization of emu, trained on the same workload as pgo
+        if self.args.pgo is None or self.args.pgo == "null":
+            print("--bolt requires a training workload given by --pgo")
+            return 1
+        build_dir = os.path.join(self.args.noop_home, "build")
+        emu, prebolt = os.path.join(build_dir, "emu"), os.path.join(build_dir, "emu.prebolt")
+        # a BOLTed emu keeps the mtime of the link it came from, so a newer emu is a fresh link
+        if os.path.exists(prebolt) and os.stat(emu).st_mtime_ns <= os.stat(prebolt).st_mtime_ns:
+            print("emu is already optimized by llvm-bolt")
+            return 0
+        os.replace(emu, prebolt)
+        # steps run in build/, so the workload path must not be relative to the caller
+        train_cmd = ["./emu.prebolt", "-i", os.path.abspath(self.args.pgo), "--max-cycles", str(self.args.pgo_max_cycle)]
+        train_cmd += shlex.split(self.args.pgo_emu_args)
+        perf_cmd = ["perf", "record", *shlex.split(self.args.bolt_perf_args), "-o", "emu.perf", "--", *train_cmd]
+        steps = [
+            f"ulimit -s {32 * 1024}; {shlex.join(perf_cmd)}",
+            ["perf2bolt", "-p", "emu.perf", "-o", "emu.fdata", "emu.prebolt"],
+            ["llvm-bolt", "emu.prebolt", "-o", "emu.bolt", "-data=emu.fdata",
+             "-reorder-blocks=ext-tsp", "-reorder-functions=hfsort+", "-split-functions",
+             "-split-all-cold", "-split-eh", "-icf=1", "-use-gnu-stack"],
+        ]
+        try:
+            for step in steps:
+                return_code = self.__exec_cmd(step, cwd=build_dir)
+                if return_code:
+                    return return_code
+            os.replace(os.path.join(build_dir, "emu.bolt"), emu)
+        finally:
+            # whatever went wrong, do not leave build/ without an emu
+            if not os.path.exists(emu):
+                os.replace(prebolt, emu)
+        prebolt_stat = os.stat(prebolt)
+        os.utime(emu, ns=(prebolt_stat.st_atime_ns, prebolt_stat.st_mtime_ns))
+        return 0
+
     def build_simv(self):
-        print("Building XiangShan simv with the following configurations")
-        self.show()
-        make_args = " ".join(map(lambda arg: f"{arg[1]}={arg[0]}", self.args.get_makefile_args()))
+        self.show("Building XiangShan simv")
+        make_args = self.args.makefile_args_str
         # TODO: make the following commands grouped as unseen scripts
         return_code = self.__exec_cmd(f'\
             eval `/usr/bin/modulecmd zsh load license`;\
@@ -259,31 +455,98 @@ class XiangShan(object):
         return return_code
 
     def run_emu(self, workload):
-        print("Running XiangShan emu with the following configurations:")
-        self.show()
-        emu_args = " ".join(map(lambda arg: f"--{arg[1]} {arg[0]}", self.args.get_emu_args()))
+        self.show("Running XiangShan emu")
+        emu_args = self.args.emu_args_str
         print("workload:", workload)
         numa_args = ""
+        numa_cores = ()
         if self.args.numa:
-            numa_info = get_free_cores(self.args.threads)
-            numa_args = f"numactl -m {numa_info[0]} -C {numa_info[1]}-{numa_info[2]}"
+            # search without the lock (it may sleep for a while), then claim only if no other
+            # worker took an overlapping window in the meantime
+            while True:
+                numa_info = get_free_cores(self.args.threads, self.__claimed_cores_snapshot, self.stop_event)
+                if numa_info is None:
+                    return 1
+                numa_cores = range(numa_info[1], numa_info[2] + 1)
+                with self.claimed_cores_lock:
+                    if self.claimed_cores.isdisjoint(numa_cores):
+                        self.claimed_cores.update(numa_cores)
+                        break
+            mem_args = {
+                "bind": f"-m {numa_info[0]}",
+                "preferred": f"--preferred={numa_info[0]}",
+                "interleave": "--interleave=all",
+            }[self.args.numa_policy]
+            # keep "-C <first>-<last>" in this form, find_numa_cores parses it from other runs
+            numa_args = f"numactl {mem_args} -C {numa_info[1]}-{numa_info[2]}"
         fork_args = "--enable-fork" if self.args.fork else ""
         diff_args = "--no-diff" if self.args.disable_diff else ""
         chiseldb_args = "--dump-db" if not self.args.disable_db else ""
         gcpt_restore_args = f"-r {self.args.gcpt_restore_bin}" if len(self.args.gcpt_restore_bin) != 0 else ""
-        return_code = self.__exec_cmd(f'ulimit -s {32 * 1024}; {numa_args} $NOOP_HOME/build/emu -i {workload} {emu_args} {fork_args} {diff_args} {chiseldb_args} {gcpt_restore_args}')
+        try:
+            if self.stop_event.is_set():
+                return 1
+            return_code = self.__exec_cmd(f'ulimit -s {32 * 1024}; {numa_args} $NOOP_HOME/build/emu -i {workload} {emu_args} {fork_args} {diff_args} {chiseldb_args} {gcpt_restore_args}')
+        finally:
+            with self.claimed_cores_lock:
+                self.claimed_cores.difference_update(numa_cores)
         return return_code
 
+    def __claimed_cores_snapshot(self):
+        with self.claimed_cores_lock:
+            return frozenset(self.claimed_cores)
+
+    def run_emu_parallel(self, workloads):
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+        # emu does the work in child processes, so threads are enough to keep several running
+        try:
+            with ThreadPoolExecutor(max_workers=self.ci_jobs) as executor:
+                futures = {executor.submit(self.run_emu, workload): workload for workload in workloads}
+                try:
+                    for future in as_completed(futures):
+                        ret = future.result()
+                        if ret:
+                            print(f"{futures[future]} failed, stopping the other workloads.")
+                            # the run has failed already, do not wait for the others to finish
+                            self.__stop_workers(futures)
+                            return ret
+                except KeyboardInterrupt:
+                    # only the main thread sees Ctrl-C
+                    self.__stop_workers(futures)
+                    print("KeyboardInterrupt, stopped the running workloads.")
+                    return 1
+            return 0
+        finally:
+            # all workers have returned here, later commands must run normally
+            self.stop_event.clear()
+
+    def __stop_workers(self, futures):
+        # keep workers from starting new emus, then interrupt the ones already running
+        self.stop_event.set()
+        for pending in futures:
+            pending.cancel()
+        with self.running_procs_lock:
+            for proc in self.running_procs:
+                try:
+                    os.killpg(proc.pid, signal.SIGINT)
+                except ProcessLookupError:
+                    # exited and reaped, but not yet dropped from running_procs
+                    pass
+
     def run_simv(self, workload):
-        print("Running XiangShan simv with the following configurations:")
-        self.show()
-        diff_args = "$NOOP_HOME/"+ args.diff
-        assert_args = "-assert finish_maxfail=30 -assert global_finish_maxfail=10000"
-        return_code = self.__exec_cmd(f'cd $NOOP_HOME/build && ./simv +workload={workload} +diff={diff_args} +dump-wave=fsdb {assert_args} | tee simv.log')
-        with open(f"{self.args.noop_home}/build/simv.log") as f:
-            content = f.read()
-            if "Offending" in content or "HIT GOOD TRAP" not in content:
-                return 1
+        self.show("Running XiangShan simv")
+        diff_args = os.path.join(self.args.noop_home, self.args.diff)
+        assert_args = ["-assert", "finish_maxfail=30", "-assert", "global_finish_maxfail=10000"]
+        build_dir = os.path.join(self.args.noop_home, "build")
+        log_file = os.path.join(build_dir, "simv.log")
+        return_code = self.__exec_cmd(["./simv", f"+workload={workload}", f"+diff={diff_args}", "+dump-wave=fsdb", *assert_args],
+                                      cwd=build_dir, log_file=log_file)
+        # no log is written when simv could not be started at all
+        if not os.path.exists(log_file):
+            return return_code or 1
+        found = find_markers_in_file(log_file, [b"Offending", b"HIT GOOD TRAP"])
+        if b"Offending" in found or b"HIT GOOD TRAP" not in found:
+            return 1
         return return_code
 
     def run(self, args):
@@ -307,14 +570,40 @@ class XiangShan(object):
                 return ret
         return 0
 
-    def __exec_cmd(self, cmd):
+    def __exec_make(self, *make_args):
+        # variables are passed as separate argv words, so no shell quoting is needed
+        argv = ["make", "-C", self.args.noop_home, *make_args, f"SIM_ARGS={self.args.chisel_args_str}"]
+        return self.__exec_cmd(argv + self.args.makefile_vars)
+
+    def __exec_cmd(self, cmd, cwd=None, log_file=None):
         env = dict(os.environ)
-        env.update(self.args.get_env_variables())
-        print("subprocess call cmd:", cmd)
+        env.update(self.args.env_variables)
+        print("subprocess call cmd:", shlex.join(cmd) if isinstance(cmd, list) else cmd)
+        # stdout is teed to log_file in-process instead of through a tee(1) pipe
+        stdout = subprocess.PIPE if log_file is not None else None
         start = time.time()
-        proc = subprocess.Popen(cmd, shell=True, env=env, preexec_fn=os.setsid)
+        # argv lists are exec'ed directly, strings are commands that need /bin/sh
+        shell = not isinstance(cmd, list)
+        # stdin is left to the driver, in --server mode it carries the requests
+        try:
+            proc = subprocess.Popen(cmd, shell=shell, env=env, cwd=cwd, stdin=subprocess.DEVNULL, stdout=stdout, start_new_session=True)
+        except OSError as e:
+            # fail like /bin/sh does for a command it cannot run, callers only look at the return code
+            print(f"subprocess call failed: {e}")
+            return 127
+        with self.running_procs_lock:
+            self.running_procs.add(proc)
+            # started while a parallel run was being stopped, after its process groups were signalled
+            if self.stop_event.is_set():
+                os.killpg(proc.pid, signal.SIGINT)
+        tee = None
+        if log_file is not None:
+            tee = threading.Thread(target=tee_output, args=(proc.stdout, log_file), daemon=True)
+            tee.start()
         try:
             return_code = proc.wait(self.timeout)
+            if tee is not None:
+                tee.join()
             end = time.time()
             print(f"Elapsed time: {end - start} seconds")
             return return_code
@@ -322,6 +611,19 @@ class XiangShan(object):
             os.killpg(os.getpgid(proc.pid), signal.SIGINT)
             print(f"KeyboardInterrupt or TimeoutExpired.")
             return 0
+        finally:
+            with self.running_procs_lock:
+                self.running_procs.discard(proc)
+
+    def __copy_build_files(self, patterns):
+        build_dir = os.path.join(self.args.noop_home, "build")
+        for pattern in patterns:
+            for src in glob.glob(os.path.join(build_dir, pattern)):
+                print(f"copy {src} to {self.args.wave_home}")
+                try:
+                    shutil.copy2(src, self.args.wave_home)
+                except OSError as e:
+                    print(f"copy failed: {e}")
 
     def __get_ci_cputest(self, name=None):
         # base_dir = os.path.join(self.args.am_home, "tests/cputest/build")
@@ -550,7 +852,8 @@ class XiangShan(object):
         if name in workloads:
             return [os.path.join("/nfs/home/share/ci-workloads", name, workloads[name])]
         # select a random SPEC checkpoint
-        assert(name == "random")
+        if name != "random":
+            raise ValueError(f"unknown CI test: {name}")
         all_cpt_dir = [
             "/nfs/home/share/checkpoints_profiles/spec06_rv64gcb_o2_20m/take_cpt",
             "/nfs/home/share/checkpoints_profiles/spec06_rv64gcb_o3_20m/take_cpt",
@@ -563,8 +866,7 @@ class XiangShan(object):
             "/nfs/home/share/checkpoints_profiles/spec06_rv64gcb_O3_20m_gcc12.2.0-intFpcOff-jeMalloc/zstd-checkpoint-0-0-0",
             "/nfs/home/share/checkpoints_profiles/spec06_gcc15_rv64gcbv_O3_lto_base_nemu_single_core_NEMU_archgroup_2024-10-12-16-05/checkpoint-0-0-0"
         ]
-        all_gcpt = load_all_gcpt(all_cpt_dir)
-        return [random.choice(all_gcpt)]
+        return [sample_one_gcpt(all_cpt_dir)]
 
     def run_ci(self, test):
         all_tests = {
@@ -582,19 +884,25 @@ class XiangShan(object):
             "f16_test": self.__get_ci_F16test,
             "zcb-test": self.__get_ci_zcbtest
         }
-        for target in all_tests.get(test, self.__get_ci_workloads)(test):
-            print(target)
-            ret = self.run_emu(target)
-            if ret:
-                if self.args.default_wave_home != self.args.wave_home:
-                    print("copy wave file to " + self.args.wave_home)
-                    self.__exec_cmd(f"cp $NOOP_HOME/build/*.vcd $WAVE_HOME")
-                    self.__exec_cmd(f"cp $NOOP_HOME/build/*.fst $WAVE_HOME")
-                    self.__exec_cmd(f"cp $NOOP_HOME/build/emu $WAVE_HOME")
-                    self.__exec_cmd(f"cp $NOOP_HOME/build/rtl/SimTop.v $WAVE_HOME")
-                    self.__exec_cmd(f"cp $NOOP_HOME/build/*.db $WAVE_HOME")
-                return ret
-        return 0
+        targets = list(all_tests.get(test, self.__get_ci_workloads)(test))
+        missing = find_missing_files(targets)
+        if missing:
+            for target in missing:
+                print(f"workload not found: {target}")
+            return 1
+        if self.ci_jobs > 1:
+            ret = self.run_emu_parallel(targets)
+        else:
+            ret = 0
+            for target in targets:
+                print(target)
+                ret = self.run_emu(target)
+                if ret:
+                    break
+        if ret and self.args.default_wave_home != self.args.wave_home:
+            print("copy wave file to " + self.args.wave_home)
+            self.__copy_build_files(["*.vcd", "*.fst", "emu", "rtl/SimTop.v", "*.db"])
+        return ret
 
     def run_ci_vcs(self, test):
         all_tests = {
@@ -612,44 +920,74 @@ class XiangShan(object):
             "f16_test": self.__get_ci_F16test,
             "zcb-test": self.__get_ci_zcbtest
         }
-        for target in all_tests.get(test, self.__get_ci_workloads)(test):
+        targets = list(all_tests.get(test, self.__get_ci_workloads)(test))
+        missing = find_missing_files(targets)
+        if missing:
+            for target in missing:
+                print(f"workload not found: {target}")
+            return 1
+        for target in targets:
             print(target)
             ret = self.run_simv(target)
             if ret:
                 if self.args.default_wave_home != self.args.wave_home:
                     print("copy wave file to " + self.args.wave_home)
-                    self.__exec_cmd(f"cp $NOOP_HOME/build/*.fsdb $WAVE_HOME")
-                    self.__exec_cmd(f"cp $NOOP_HOME/build/simv $WAVE_HOME")
-                    self.__exec_cmd(f"cp $NOOP_HOME/build/rtl/SimTop.v $WAVE_HOME")
-                    self.__exec_cmd(f"cp $NOOP_HOME/build/*.db $WAVE_HOME")
+                    self.__copy_build_files(["*.fsdb", "simv", "rtl/SimTop.v", "*.db"])
                 return ret
         return 0
 
-def get_free_cores(n):
-    numa_re = re.compile(r'.*numactl +.*-C +([0-9]+)-([0-9]+).*')
+def find_numa_cores():
+    # read /proc directly rather than building a psutil.Process per pid
+    numa_cores = []
+    for entry in os.scandir('/proc'):
+        if not entry.name.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry.name}/cmdline', 'rb') as f:
+                cmdline = f.read()
+            if b'numactl' not in cmdline:
+                continue
+            joint = cmdline.rstrip(b'\0').replace(b'\0', b' ').decode(errors='replace')
+            numa_match = NUMA_RE.search(joint)
+            if not numa_match:
+                continue
+            with open(f'/proc/{entry.name}/comm') as f:
+                name = f.read()
+        except OSError:
+            continue
+        if 'ssh' not in name:
+            numa_cores.extend(range(int(numa_match.group(1)), int(numa_match.group(2)) + 1))
+    return numa_cores
+
+def get_free_cores(n, busy_cores=frozenset, stop_event=None):
+    # busy_cores returns the cores claimed elsewhere, called again on every attempt;
+    # returns None if stop_event is set while waiting
+    # imported here so that runs without --numa do not pay for (or need) psutil
+    import psutil
+    num_logical_core = psutil.cpu_count(logical=False)
+    num_window = num_logical_core // n
+    # seed the per-cpu counters so that later calls return immediately
+    psutil.cpu_percent(interval=None, percpu=True)
+    time.sleep(0.1)
     while True:
-        disable_cores = []
-        for proc in psutil.process_iter():
-            try:
-                joint = ' '.join(proc.cmdline())
-                numa_match = numa_re.match(joint)
-                if numa_match and 'ssh' not in proc.name():
-                    disable_cores.extend(range(int(numa_match.group(1)), int(numa_match.group(2)) + 1))
-            except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
-                pass
-        num_logical_core = psutil.cpu_count(logical=False)
-        core_usage = psutil.cpu_percent(interval=1, percpu=True)
-        num_window = num_logical_core // n
+        disable_cores = frozenset(find_numa_cores()).union(busy_cores())
+        # usage since the previous call: the first 100ms, then the whole back-off sleep
+        core_usage = psutil.cpu_percent(interval=None, percpu=True)
         for i in range(num_window):
-            if set(disable_cores) & set(range(i * n, i * n + n)):
+            if not disable_cores.isdisjoint(range(i * n, i * n + n)):
                 continue
             window_usage = core_usage[i * n : i * n + n]
             if sum(window_usage) < 30 * n and True not in map(lambda x: x > 90, window_usage):
                 return (((i * n) % num_logical_core) // (num_logical_core // 2), i * n, i * n + n - 1)
         print(f"No free {n} cores found. CPU usage: {core_usage}\n")
-        time.sleep(random.uniform(1, 60))
+        if stop_event is None:
+            time.sleep(random.uniform(1, 60))
+        elif stop_event.wait(random.uniform(1, 60)):
+            return None
 
-if __name__ == "__main__":
+@functools.lru_cache(maxsize=None)
+def get_parser():
+    # built once per process, so harnesses that import this module and parse repeatedly reuse it
     parser = argparse.ArgumentParser(description='Python wrapper for XiangShan')
     parser.add_argument('workload', nargs='?', type=str, default="",
                         help='input workload file in binary format')
@@ -662,6 +1000,11 @@ if __name__ == "__main__":
     parser.add_argument('--ci-vcs', nargs='?', type=str, const="", help='run CI tests on simv')
     parser.add_argument('--clean', action='store_true', help='clean up XiangShan CI workspace')
     parser.add_argument('--timeout', nargs='?', type=int, default=None, help='timeout (in seconds)')
+    parser.add_argument('--ci-jobs', type=int, default=1, help='number of CI workloads to run on emu in parallel')
+    parser.add_argument('--verbose', action='store_true', help='print the configuration before every action and test')
+    parser.add_argument('--args-file', type=str, default=None, help='JSON file with saved option values, keyed by option name with underscores')
+    parser.add_argument('--server', action='store_true',
+                        help='keep the configuration loaded and run one JSON request per stdin line, e.g. {"workload": "a.bin"} or {"ci": "cputest"}; replies go to stdout, logs to stderr')
     # environment variables
     parser.add_argument('--nemu', nargs='?', type=str, help='path to nemu')
     parser.add_argument('--am', nargs='?', type=str, help='path to nexus-am')
@@ -686,6 +1029,9 @@ if __name__ == "__main__":
     parser.add_argument('--issue', nargs='?', type=str, help='CHI issue')
     # emu arguments
     parser.add_argument('--numa', action='store_true', help='use numactl')
+    parser.add_argument('--numa-policy', choices=['bind', 'preferred', 'interleave'], default='bind',
+                        help='memory policy with --numa: bind to or prefer the node of the selected cores, or interleave across all nodes; '
+                             'it covers both the emu memory and the difftest reference so loaded into emu')
     parser.add_argument('--diff', nargs='?', default="./ready-to-run/riscv64-nemu-interpreter-so", type=str, help='nemu so')
     parser.add_argument('--max-instr', nargs='?', type=int, help='max instr')
     parser.add_argument('--disable-fork', action='store_true', help='disable lightSSS')
@@ -694,14 +1040,112 @@ if __name__ == "__main__":
     parser.add_argument('--gcpt-restore-bin', type=str, default="", help="specify the bin used to restore from gcpt")
     # both makefile and emu arguments
     parser.add_argument('--no-db', action='store_true', help='disable chiseldb dump')
-    parser.add_argument('--pgo', nargs='?', type=str, help='workload for pgo (null to disable pgo)')
+    parser.add_argument('--pgo', nargs='?', type=str,
+                        help='workload for pgo, "auto" for ready-to-run/coremark-2-iteration.bin if present (null or off to disable pgo)')
     parser.add_argument('--pgo-max-cycle', nargs='?', default=400000, type=int, help='maximun cycle to train pgo')
     parser.add_argument('--pgo-emu-args', nargs='?', default='--no-diff', type=str, help='emu arguments for pgo')
     parser.add_argument('--llvm-profdata', nargs='?', type=str, help='corresponding llvm-profdata command of clang to compile emu, do not set with GCC')
+    parser.add_argument('--bolt', action='store_true', help='optimize the built emu with llvm-bolt, trained on the pgo workload')
+    parser.add_argument('--bolt-perf-args', type=str, default='-e cycles:u -j any,u', help='perf record arguments for bolt training')
+    return parser
+
+def check_saved_arg(action, value, source):
+    # saved values bypass the command line, so apply the checks argparse would have done on it
+    invalid = f"invalid value for {action.dest} in {source}: {value!r}"
+    if action.nargs == 0:
+        if not isinstance(value, bool):
+            raise ValueError(invalid)
+        return value
+    if isinstance(value, (list, dict)):
+        # every valued option takes a single word, str() would hide the mistake
+        raise ValueError(invalid)
+    if value is not None and action.type is not None:
+        try:
+            value = action.type(str(value))
+        except (TypeError, ValueError):
+            raise ValueError(invalid) from None
+    if value is not None and action.choices is not None and value not in action.choices:
+        raise ValueError(f"{invalid} (choose from {', '.join(map(repr, action.choices))})")
+    return value
+
+def check_saved_args(parser, saved_args, source):
+    return {action.dest: check_saved_arg(action, saved_args[action.dest], source)
+            for action in parser._actions if action.dest in saved_args}
 
-    args = parser.parse_args()
+def parse_args(argv=None):
+    parser = get_parser()
+    # options saved in --args-file act as defaults, explicit command-line options still win
+    preargs, _ = parser.parse_known_args(argv)
+    if preargs.args_file is not None:
+        with open(preargs.args_file) as f:
+            try:
+                saved_args = json.load(f)
+            except ValueError as e:
+                parser.error(f"{preargs.args_file} is not valid JSON: {e}")
+        if not isinstance(saved_args, dict):
+            parser.error(f"{preargs.args_file} must hold a JSON object of option values")
+        unknown = set(saved_args) - set(vars(preargs))
+        if unknown:
+            parser.error(f"unknown options in {preargs.args_file}: {', '.join(sorted(unknown))}")
+        try:
+            saved_args = check_saved_args(parser, saved_args, preargs.args_file)
+        except ValueError as e:
+            parser.error(str(e))
+        # set them as parser defaults, so that a positional workload left out on the command line
+        # does not overwrite the saved one; the parser is memoised, so change a copy of it
+        parser = copy.deepcopy(parser)
+        parser.set_defaults(**saved_args)
+    return parser.parse_args(argv)
 
+# options a --server request may set, all other options are fixed at startup
+SERVER_ACTIONS = ["workload", "build", "generate", "vcs_gen", "vcs_build", "ci", "ci_vcs", "clean"]
+
+def serve(args):
+    defaults = vars(get_parser().parse_args([]))
+    idle_actions = {name: defaults[name] for name in SERVER_ACTIONS}
+    failed = False
+    # replies get the original stdout to themselves, logs of the driver and its children go to stderr
+    sys.stdout.flush()
+    replies = os.fdopen(os.dup(sys.stdout.fileno()), "w")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    def reply(**fields):
+        sys.stdout.flush()
+        print(json.dumps(fields), file=replies, flush=True)
     xs = XiangShan(args)
-    ret = xs.run(args)
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError("request must be a JSON object")
+            unknown = set(request) - set(SERVER_ACTIONS)
+            if unknown:
+                raise ValueError(f"unsupported options: {', '.join(sorted(unknown))}")
+            request = check_saved_args(get_parser(), request, "request")
+        except ValueError as e:
+            reply(error=str(e))
+            failed = True
+            continue
+        request_args = argparse.Namespace(**{**vars(args), **idle_actions, **request})
+        try:
+            ret = xs.run(request_args)
+        except Exception as e:
+            # a broken request must not end the session
+            reply(error=f"{type(e).__name__}: {e}")
+            failed = True
+            continue
+        failed = failed or ret != 0
+        reply(ret=ret)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    if args.server:
+        ret = serve(args)
+    else:
+        xs = XiangShan(args)
+        ret = xs.run(args)
 
     sys.exit(ret)